@@ -100,7 +100,8 @@ class AgentConfig:
         
         return {
             "port": server_config.get("port", 50002),
-            "allowedHosts": all_hosts
+            "allowedHosts": all_hosts,
+            "perMessageDeflate": server_config.get("perMessageDeflate", False)
         }
 
 # Singleton instance
@@ -6,9 +6,22 @@ from enum import Enum
 from typing import Optional, Dict, Any, Union
 from dataclasses import dataclass, field
 from datetime import datetime
+import itertools
+import time
 import uuid
 
 
+# Message ids only need to be unique, not unpredictable: a per-process prefix
+# plus a counter avoids a CSPRNG read and UUID formatting for every message
+_MESSAGE_ID_PREFIX = uuid.uuid4().hex[:8]
+_message_counter = itertools.count(1)
+
+
+def next_message_id() -> str:
+    """Return a new message id, unique across the server process and its restarts"""
+    return f"{_MESSAGE_ID_PREFIX}-{next(_message_counter)}"
+
+
 class MessageType(Enum):
     """Message types for WebSocket communication"""
     # User messages
@@ -69,16 +82,28 @@ class EventType(Enum):
     ERROR_OCCURRED = "error_occurred"
 
 
-@dataclass
+@dataclass(slots=True)
 class Message:
     """Base message class"""
-    id: str = field(default_factory=lambda: str(uuid.uuid4()))
+    id: str = field(default_factory=next_message_id)
     type: MessageType = MessageType.USER_MESSAGE
     content: str = ""
-    timestamp: datetime = field(default_factory=datetime.now)
+    # Wall-clock time in nanoseconds; an int is far smaller than a datetime and
+    # is only converted when a message is rendered
+    timestamp_ns: int = field(default_factory=time.time_ns)
     status: MessageStatus = MessageStatus.PENDING
     metadata: Dict[str, Any] = field(default_factory=dict)
     
+    @property
+    def timestamp(self) -> datetime:
+        """Message time as a local datetime"""
+        return datetime.fromtimestamp(self.timestamp_ns / 1e9)
+    
+    @property
+    def timestamp_ms(self) -> int:
+        """Message time in epoch milliseconds, as used by the frontend"""
+        return self.timestamp_ns // 1_000_000
+    
     def to_dict(self) -> Dict[str, Any]:
         """Convert message to dictionary"""
         return {
@@ -91,14 +116,14 @@ class Message:
         }
 
 
-@dataclass
+@dataclass(slots=True)
 class UserMessage(Message):
     """User message"""
     type: MessageType = MessageType.USER_MESSAGE
     session_id: Optional[str] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class AssistantMessage(Message):
     """Assistant response message"""
     type: MessageType = MessageType.ASSISTANT_RESPONSE
@@ -107,7 +132,7 @@ class AssistantMessage(Message):
     tool_calls: list = field(default_factory=list)
 
 
-@dataclass
+@dataclass(slots=True)
 class ToolMessage(Message):
     """Tool execution message - 参考 ADK Web 实现"""
     type: MessageType = MessageType.TOOL_CALL
@@ -121,7 +146,8 @@ class ToolMessage(Message):
     
     def to_dict(self) -> Dict[str, Any]:
         """Convert tool message to dictionary - 参考 ADK Web 格式"""
-        base_dict = super().to_dict()
+        # slots=True rebuilds the class, so zero-argument super() is unavailable here
+        base_dict = Message.to_dict(self)
         base_dict.update({
             "tool_name": self.tool_name,
             "tool_id": self.tool_id,
@@ -134,7 +160,7 @@ class ToolMessage(Message):
         return base_dict
 
 
-@dataclass
+@dataclass(slots=True)
 class SessionMessage(Message):
     """Session management message"""
     type: MessageType = MessageType.SESSION_CREATED
@@ -142,7 +168,7 @@ class SessionMessage(Message):
     session_data: Optional[Dict[str, Any]] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class SystemMessage(Message):
     """System message"""
     type: MessageType = MessageType.SYSTEM_INFO
@@ -150,7 +176,7 @@ class SystemMessage(Message):
     code: Optional[str] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class WebSocketMessage:
     """WebSocket message wrapper"""
     type: str
@@ -163,7 +189,7 @@ class WebSocketMessage:
         return {
             "type": self.type,
             "data": self.data,
-            "id": self.id or str(uuid.uuid4()),
+            "id": self.id or next_message_id(),
             "timestamp": self.timestamp.isoformat()
         }
 
@@ -0,0 +1,31 @@
+"""
+JSON serialization helpers for WebSocket transmission
+
+Frames are sent as binary UTF-8 JSON. orjson writes non-ASCII text (e.g. CJK
+shell output) as raw UTF-8 rather than \\uXXXX escapes, so frames stay compact
+without a separate binary encoding such as MessagePack.
+"""
+
+from typing import Any, Union
+
+import orjson
+
+
+def dumps(payload: Any) -> bytes:
+    """Serialize a payload to UTF-8 JSON bytes"""
+    return orjson.dumps(payload, default=str)
+
+
+def loads(data: Union[str, bytes]) -> Any:
+    """Parse a JSON frame received from the client"""
+    return orjson.loads(data)
+
+
+def dumps_pretty(payload: Any) -> str:
+    """Serialize a payload to indented JSON text for display"""
+    return orjson.dumps(payload, default=str, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode('utf-8')
+
+
+async def send_json(websocket, payload: Any):
+    """Send a payload as a pre-serialized binary JSON frame"""
+    await websocket.send_bytes(dumps(payload))
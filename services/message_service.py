@@ -5,15 +5,17 @@ Handles message validation, processing, and response generation
 
 import asyncio
 import logging
-from typing import Dict, Any, Optional, List, AsyncGenerator
+import time
+from typing import Dict, Any, Optional, List, AsyncGenerator, Tuple, Callable
+from collections import OrderedDict
+from operator import attrgetter
 from datetime import datetime
-import uuid
-import json
 
 from google.adk import Runner
 from google.genai import types
 
 from core.event_handlers import EventProcessor, EventContext, EventType
+from core.serialization import dumps, dumps_pretty, send_json
 from core.state_machine import SessionState, StateMachine
 from config.photon_config import CHARGING_ENABLED
 from services.photon_service import get_photon_service
@@ -21,25 +23,49 @@ from services.photon_service import get_photon_service
 # Import message types from core module
 from core.message_types import (
     MessageType, MessageStatus, Message, UserMessage,
-    AssistantMessage, ToolMessage, SystemMessage
+    AssistantMessage, ToolMessage, SystemMessage, next_message_id
 )
 
 logger = logging.getLogger(__name__)
 
+# 序列化后的消息历史缓存的最大会话数
+HISTORY_CACHE_SIZE = 32
+
+# 一次调用取出 usage_metadata 的三个 token 计数
+_usage_token_counts = attrgetter('prompt_token_count', 'candidates_token_count', 'total_token_count')
+
 
 class MessageService:
     """Service for processing messages and managing conversations"""
     
-    def __init__(self, event_processor: EventProcessor, websocket=None):
+    def __init__(self, event_processor: EventProcessor, websocket=None, sender: Optional[Callable[[Dict[str, Any]], None]] = None):
         self.event_processor = event_processor
         self.message_history: Dict[str, List[Message]] = {}
         self.processing_messages: Dict[str, Dict[str, Any]] = {}
+        # session_id -> (缓存时的消息数量, 序列化后的 session_messages 帧)
+        self._history_cache: "OrderedDict[str, Tuple[int, bytes]]" = OrderedDict()
         self.websocket = websocket  # 添加WebSocket引用
+        # 连接的发送队列入口；设置后工具状态帧入队合并发送，不再逐条直接写 WebSocket
+        self.sender = sender
     
     def set_websocket(self, websocket):
         """设置WebSocket引用"""
         self.websocket = websocket
     
+    async def _send(self, payload: Dict[str, Any]):
+        """Send a frame to the frontend, through the connection outbox when available"""
+        if self.sender is not None:
+            self.sender(payload)
+        elif self.websocket is not None:
+            await send_json(self.websocket, payload)
+    
+    def _append_message(self, session_id: str, message: Message):
+        """Append a message to the session history and drop its cached serialization"""
+        if session_id not in self.message_history:
+            self.message_history[session_id] = []
+        self.message_history[session_id].append(message)
+        self._history_cache.pop(session_id, None)
+    
     async def process_user_message(
         self, 
         session_id: str, 
@@ -50,7 +76,7 @@ class MessageService:
         ) -> Dict[str, Any]:
         """Process a user message and generate response"""
         
-        message_id = str(uuid.uuid4())
+        message_id = next_message_id()
         context = EventContext(
             session_id=session_id,
             user_id=user_id,
@@ -71,9 +97,7 @@ class MessageService:
                 session_id=session_id
             )
             
-            if session_id not in self.message_history:
-                self.message_history[session_id] = []
-            self.message_history[session_id].append(user_message)
+            self._append_message(session_id, user_message)
             
             # logger.info(f"用户消息已保存到会话 {session_id}: {content[:50]}...")
             # logger.info(f"会话 {session_id} 当前消息数量: {len(self.message_history[session_id])}")
@@ -87,7 +111,7 @@ class MessageService:
                 tool_calls=response.get('tool_calls', [])
             )
             
-            self.message_history[session_id].append(assistant_message)
+            self._append_message(session_id, assistant_message)
             
             # logger.info(f"助手消息已保存到会话 {session_id}: {response.get('content', '')[:50]}...")
             # logger.info(f"会话 {session_id} 当前消息数量: {len(self.message_history[session_id])}")
@@ -146,11 +170,16 @@ class MessageService:
             parts=[types.Part(text=content)]
         )
         
-        # Track events and tool calls - 参考 ADK Web 的事件追踪方式
-        all_events = []
+        # Track tool calls - 参考 ADK Web 的事件追踪方式；事件处理完即释放，不在内存中累积
+        events_count = 0
+        final_response = None
+        usage_metadata = {
+            'prompt_tokens': 0,
+            'candidates_tokens': 0,
+            'total_tokens': 0
+        }
         tool_calls = []
-        seen_tool_calls = set()
-        seen_tool_responses = set()
+        seen_tools = set()  # ('call' | 'response', id)，调用和结果共用一个去重集合
         long_running_tool_ids = set()  # 跟踪长期运行的工具ID
         
         # Process with agent
@@ -159,66 +188,85 @@ class MessageService:
             user_id=context.user_id,
             session_id=context.session_id
         ):
-            all_events.append(event)
+            events_count += 1
             # logger.info(f"Received event: {type(event).__name__}")
             # logger.debug(f"Received event: {type(event).__name__}")
             
             # 参考 ADK Web: 检查长期运行的工具ID
-            if hasattr(event, 'long_running_tool_ids') and event.long_running_tool_ids:
+            # ADK Event / genai Part 均为字段固定的模型，直接读取属性，无需 hasattr 探测
+            if event.long_running_tool_ids:
                 long_running_tool_ids.update(event.long_running_tool_ids)
                 logger.info(f"Long running tool IDs detected: {event.long_running_tool_ids}")
             
-            # Process tool calls - 参考 ADK Web 的工具调用处理
-            if hasattr(event, 'content') and event.content and hasattr(event.content, 'parts'):
+            # Process tool calls and text - 参考 ADK Web 的工具调用处理
+            text_parts = []
+            if event.content and event.content.parts:
+                # 同一事件内的工具消息与推送帧共用一个时间戳
+                event_time_ns = time.time_ns()
                 for part in event.content.parts:
                     # Handle function calls (tool calls) - 参考 ADK Web 的 function_call 处理
-                    if hasattr(part, 'function_call') and part.function_call:
+                    function_call = part.function_call
+                    if function_call:
                         await self._handle_tool_call(
-                            part.function_call, 
+                            function_call, 
                             event, 
                             context, 
-                            seen_tool_calls,
-                            long_running_tool_ids
+                            seen_tools,
+                            long_running_tool_ids,
+                            event_time_ns
                         )
                         tool_calls.append({
-                            'name': getattr(part.function_call, 'name', 'unknown'),
-                            'id': getattr(part.function_call, 'id', 'unknown'),
+                            'name': function_call.name or 'unknown',
+                            'id': function_call.id or 'unknown',
                             'status': 'executing'
                         })
+                        continue
                     
                     # Handle function responses (tool results) - 参考 ADK Web 的 function_response 处理
-                    elif hasattr(part, 'function_response') and part.function_response:
-                        await self._handle_tool_response(part.function_response, context, seen_tool_responses)
-        
-        # Extract final response
-        final_response = self._extract_final_response(all_events)
-        
-        # Extract token usage information - 参考原始代码的token提取逻辑
-        usage_metadata = self._extract_usage_metadata(all_events)
+                    function_response = part.function_response
+                    if function_response:
+                        await self._handle_tool_response(function_response, context, seen_tools, event_time_ns)
+                        continue
+                    
+                    if part.text:
+                        text_parts.append(part.text)
+            
+            # 文本到达即推送给前端；最终回复取最后一个带文本的事件，在同一遍遍历中记录
+            if text_parts:
+                text = '\n'.join(text_parts)
+                final_response = text
+                if self.websocket:
+                    await self._send({
+                        "type": "assistant_delta",
+                        "content": text,
+                        "session_id": context.session_id
+                    })
+            
+            # Accumulate token usage information - 参考原始代码的token提取逻辑
+            self._accumulate_usage_metadata(usage_metadata, event)
         
         return {
-            'content': final_response,
+            'content': final_response or "No response generated",
             'tool_calls': tool_calls,
             'usage_metadata': usage_metadata,  # 添加token使用信息
-            'events': all_events,  # 保留事件信息用于后续处理
-            'events_count': len(all_events),
+            'events_count': events_count,
             'long_running_tool_ids': list(long_running_tool_ids)  # 返回长期运行的工具ID列表
         }
     
-    async def _handle_tool_call(self, function_call, event, context: EventContext, seen_tool_calls: set, long_running_tool_ids: set):
+    async def _handle_tool_call(self, function_call, event, context: EventContext, seen_tools: set, long_running_tool_ids: set, timestamp_ns: int):
         """Handle tool call event and send to frontend - 参考 ADK Web 实现"""
-        tool_name = getattr(function_call, 'name', 'unknown')
-        tool_id = getattr(function_call, 'id', tool_name)
+        tool_name = function_call.name or 'unknown'
+        tool_id = function_call.id or tool_name
         
         # Avoid duplicate tool calls
-        if tool_id in seen_tool_calls:
+        key = ('call', tool_id)
+        if key in seen_tools:
             return
-        seen_tool_calls.add(tool_id)
+        seen_tools.add(key)
         
         # 参考 ADK Web: 检查是否为长期运行的工具
-        is_long_running = False
-        if hasattr(function_call, 'id') and function_call.id in long_running_tool_ids:
-            is_long_running = True
+        is_long_running = function_call.id in long_running_tool_ids
+        if is_long_running:
             logger.debug(f"Long running tool detected: {tool_name} (ID: {tool_id})")
         
         # Record tool call started event
@@ -240,13 +288,12 @@ class MessageService:
             tool_id=tool_id,
             tool_status=MessageStatus.PROCESSING,
             is_long_running=is_long_running,
-            session_id=context.session_id
+            session_id=context.session_id,
+            timestamp_ns=timestamp_ns
         )
         
         # Save tool message to history
-        if context.session_id not in self.message_history:
-            self.message_history[context.session_id] = []
-        self.message_history[context.session_id].append(tool_message)
+        self._append_message(context.session_id, tool_message)
         
         # logger.info(f"工具调用消息已保存到会话 {context.session_id}: {tool_name} (long_running: {is_long_running})")
         
@@ -254,16 +301,16 @@ class MessageService:
         if self.websocket:
             try:
                 # 提取工具调用的输入参数 - 参考 ADK Web 的 args 字段
-                tool_args = getattr(function_call, 'args', None)
+                tool_args = function_call.args
                 
-                await self.websocket.send_json({
+                await self._send({
                     "type": "tool",
                     "tool_name": tool_name,
                     "tool_id": tool_id,
                     "status": "executing",
                     "is_long_running": is_long_running,
                     "args": tool_args,  # 添加输入参数
-                    "timestamp": datetime.now().isoformat(),
+                    "timestamp": timestamp_ns // 1_000_000,
                     "session_id": context.session_id
                 })
                 logger.info(f"Tool call status sent to frontend: {tool_name} with args: {tool_args}")
@@ -272,21 +319,19 @@ class MessageService:
         
         logger.info(f"Tool call detected: {tool_name} (ID: {tool_id}, long_running: {is_long_running})")
     
-    async def _handle_tool_response(self, function_response, context: EventContext, seen_tool_responses: set):
+    async def _handle_tool_response(self, function_response, context: EventContext, seen_tools: set, timestamp_ns: int):
         """Handle tool response event and send to frontend - 参考 ADK Web 实现"""
-        tool_name = getattr(function_response, 'name', 'unknown')
-        response_id = f"{tool_name}_response"
-        
-        if hasattr(function_response, 'id'):
-            response_id = function_response.id
+        tool_name = function_response.name or 'unknown'
+        response_id = function_response.id or f"{tool_name}_response"
         
         # Avoid duplicate responses
-        if response_id in seen_tool_responses:
+        key = ('response', response_id)
+        if key in seen_tools:
             return
-        seen_tool_responses.add(response_id)
+        seen_tools.add(key)
         
         # Get response data - 参考 ADK Web 的响应处理
-        response_data = getattr(function_response, 'response', None)
+        response_data = function_response.response
         result_str = self._format_tool_response(response_data)
         
         # Record tool call completed event
@@ -308,26 +353,25 @@ class MessageService:
             tool_id=response_id,
             tool_status=MessageStatus.COMPLETED,
             result=result_str,
-            session_id=context.session_id
+            session_id=context.session_id,
+            timestamp_ns=timestamp_ns
         )
         
         # Save tool completion message to history
-        if context.session_id not in self.message_history:
-            self.message_history[context.session_id] = []
-        self.message_history[context.session_id].append(tool_completion_message)
+        self._append_message(context.session_id, tool_completion_message)
         
         # logger.info(f"工具完成消息已保存到会话 {context.session_id}: {tool_name} (ID: {response_id})")
         
         # Send tool completion status to frontend - 参考 ADK Web 的消息格式
         if self.websocket:
             try:
-                await self.websocket.send_json({
+                await self._send({
                     "type": "tool",
                     "tool_name": tool_name,
                     "tool_id": response_id,
                     "status": "completed",
                     "result": result_str,
-                    "timestamp": datetime.now().isoformat(),
+                    "timestamp": timestamp_ns // 1_000_000,
                     "session_id": context.session_id
                 })
                 logger.info(f"Tool completion status sent to frontend: {tool_name}")
@@ -341,64 +385,31 @@ class MessageService:
         if response_data is None:
             return ""
         
-        if isinstance(response_data, dict):
-            try:
-                return json.dumps(response_data, indent=2, ensure_ascii=False)
-            except:
-                return str(response_data)
-        elif isinstance(response_data, (list, tuple)):
+        if isinstance(response_data, (dict, list, tuple)):
             try:
-                return json.dumps(response_data, indent=2, ensure_ascii=False)
-            except:
+                return dumps_pretty(response_data)
+            except TypeError:
                 return str(response_data)
         elif isinstance(response_data, str):
             return response_data
         else:
             return str(response_data)
     
-    def _extract_final_response(self, events: List[Any]) -> str:
-        """Extract final response from events"""
-        # Look for the last valid response
-        for event in reversed(events):
-            if hasattr(event, 'content') and event.content:
-                content = event.content
-                if hasattr(content, 'parts') and content.parts:
-                    text_parts = []
-                    for part in content.parts:
-                        if hasattr(part, 'text') and part.text:
-                            text_parts.append(part.text)
-                    if text_parts:
-                        return '\n'.join(text_parts)
-                elif hasattr(content, 'text') and content.text:
-                    return content.text
-            elif hasattr(event, 'text') and event.text:
-                return event.text
-            elif hasattr(event, 'output') and event.output:
-                return event.output
-            elif hasattr(event, 'message') and event.message:
-                return event.message
-        
-        return "No response generated"
-    
-    def _extract_usage_metadata(self, events: List[Any]) -> Dict[str, int]:
-        """Extract token usage metadata from events - 参考原始代码的token提取逻辑"""
-        usage_metadata = {
-            'prompt_tokens': 0,
-            'candidates_tokens': 0,
-            'total_tokens': 0
-        }
-        
-        for event in events:
-            # logger.info(event)
-            # 检查事件是否有 usage_metadata 属性
-            if hasattr(event, 'usage_metadata') and event.usage_metadata:
-                if hasattr(event, 'author') and event.author != "Question_Answer_Agent":
-                # logger.info(f"Found usage_metadata in event: {event.usage_metadata}")
-                    usage_metadata['prompt_tokens'] += getattr(event.usage_metadata, 'prompt_token_count', 0)
-                    usage_metadata['candidates_tokens'] += getattr(event.usage_metadata, 'candidates_token_count', 0)
-                    usage_metadata['total_tokens'] += getattr(event.usage_metadata, 'total_token_count', 0)
-        
-        return usage_metadata
+    def _accumulate_usage_metadata(self, usage_metadata: Dict[str, int], event: Any):
+        """Add an event's token usage to the running totals - 参考原始代码的token提取逻辑"""
+        # 检查事件是否有 usage_metadata 属性
+        usage = getattr(event, 'usage_metadata', None)
+        if usage and getattr(event, 'author', "Question_Answer_Agent") != "Question_Answer_Agent":
+            try:
+                prompt, candidates, total = _usage_token_counts(usage)
+            except AttributeError:
+                prompt = getattr(usage, 'prompt_token_count', 0)
+                candidates = getattr(usage, 'candidates_token_count', 0)
+                total = getattr(usage, 'total_token_count', 0)
+            # 未上报的计数字段为 None
+            usage_metadata['prompt_tokens'] += prompt or 0
+            usage_metadata['candidates_tokens'] += candidates or 0
+            usage_metadata['total_tokens'] += total or 0
     
     async def _process_photon_charging(
         self, 
@@ -482,8 +493,9 @@ class MessageService:
         messages = self.message_history[session_id]
         # logger.info(f"获取会话 {session_id} 的消息历史，共 {len(messages)} 条消息")
         
-        # 转换为前端期望的格式
+        # 转换为前端期望的格式；timestamp 为毫秒时间戳，前端直接 new Date(timestamp)
         formatted_messages = []
+        debug_enabled = logger.isEnabledFor(logging.DEBUG)
         for msg in messages:
             try:
                 # 根据消息类型转换为前端期望的格式
@@ -492,7 +504,7 @@ class MessageService:
                         "id": msg.id,
                         "role": "user",
                         "content": msg.content,
-                        "timestamp": msg.timestamp.isoformat(),
+                        "timestamp": msg.timestamp_ms,
                         "session_id": msg.session_id
                     }
                 elif isinstance(msg, AssistantMessage):
@@ -500,7 +512,7 @@ class MessageService:
                         "id": msg.id,
                         "role": "assistant",
                         "content": msg.content,
-                        "timestamp": msg.timestamp.isoformat(),
+                        "timestamp": msg.timestamp_ms,
                         "session_id": msg.session_id,
                         "tool_calls": msg.tool_calls
                     }
@@ -512,7 +524,7 @@ class MessageService:
                             "id": msg.id,
                             "role": "tool",
                             "content": msg.content,
-                            "timestamp": msg.timestamp.isoformat(),
+                            "timestamp": msg.timestamp_ms,
                             "session_id": msg.session_id,
                             "tool_name": msg.tool_name,
                             "tool_status": msg.tool_status.value,
@@ -524,7 +536,7 @@ class MessageService:
                             "id": msg.id,
                             "role": "tool",
                             "content": msg.content,
-                            "timestamp": msg.timestamp.isoformat(),
+                            "timestamp": msg.timestamp_ms,
                             "session_id": msg.session_id,
                             "tool_name": msg.tool_name,
                             "tool_status": msg.tool_status.value,
@@ -535,19 +547,40 @@ class MessageService:
                     formatted_msg = msg.to_dict()
                 
                 formatted_messages.append(formatted_msg)
-                logger.debug(f"格式化消息: {formatted_msg['role']} - {formatted_msg['content'][:30]}...")
+                if debug_enabled:
+                    logger.debug("格式化消息: %s - %s...", formatted_msg['role'], formatted_msg['content'][:30])
                 
             except Exception as e:
                 logger.error(f"格式化消息失败: {e}, 消息: {msg}")
                 continue
         
-        logger.info(f"会话 {session_id} 格式化完成，共 {len(formatted_messages)} 条消息")
+        logger.debug("会话 %s 格式化完成，共 %d 条消息", session_id, len(formatted_messages))
         return formatted_messages
     
+    def get_serialized_history(self, session_id: str) -> bytes:
+        """Get the session_messages frame for a session, serialized and cached until the next message"""
+        message_count = self.get_message_count(session_id)
+        cached = self._history_cache.get(session_id)
+        if cached is not None and cached[0] == message_count:
+            self._history_cache.move_to_end(session_id)
+            return cached[1]
+        
+        payload = dumps({
+            "type": "session_messages",
+            "session_id": session_id,
+            "messages": self.get_message_history(session_id)
+        })
+        
+        self._history_cache[session_id] = (message_count, payload)
+        if len(self._history_cache) > HISTORY_CACHE_SIZE:
+            self._history_cache.popitem(last=False)
+        return payload
+    
     def clear_message_history(self, session_id: str):
         """Clear message history for a session"""
         if session_id in self.message_history:
             del self.message_history[session_id]
+        self._history_cache.pop(session_id, None)
     
     def get_message_count(self, session_id: str) -> int:
         """Get message count for a session"""
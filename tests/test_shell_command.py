@@ -0,0 +1,98 @@
+"""
+Regression tests for shell command execution in websocket-server-refactored.py
+
+Run from the repository root: python -m unittest discover tests
+"""
+
+import asyncio
+import importlib.util
+import os
+import shutil
+import sys
+import unittest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def installed(name):
+    try:
+        return importlib.util.find_spec(name) is not None
+    except ModuleNotFoundError:
+        return False
+
+
+HAS_SERVER_DEPS = installed("fastapi") and installed("google.adk")
+
+
+def load_server():
+    """Import the server module (its file name is not a valid module name)"""
+    spec = importlib.util.spec_from_file_location("websocket_server", ROOT / "websocket-server-refactored.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class RecordingContext:
+    """Minimal stand-in for ConnectionContext: records every frame enqueued"""
+
+    def __init__(self):
+        self.frames = []
+        self.is_open = True
+        self.shell_state = {"cwd": str(ROOT), "env": None}
+
+    def enqueue(self, frame):
+        self.frames.append(frame)
+
+
+@unittest.skipUnless(HAS_SERVER_DEPS, "server dependencies are not installed")
+@unittest.skipUnless(shutil.which("setsid"), "setsid is not available")
+class ShellCommandTimeoutTest(unittest.IsolatedAsyncioTestCase):
+    """Commands whose children leave the process group must still finish on time"""
+
+    @classmethod
+    def setUpClass(cls):
+        cwd = os.getcwd()
+        os.chdir(ROOT)
+        try:
+            cls.server = load_server()
+        finally:
+            os.chdir(cwd)
+
+    def setUp(self):
+        self.original_timeout = self.server.SHELL_TIMEOUT
+        self.server.SHELL_TIMEOUT = 2.0
+        # 命令本身的时限 + 退出后读取剩余输出的宽限期 + 余量
+        self.bound = self.server.SHELL_TIMEOUT + self.server.SHELL_DRAIN_GRACE + 2.0
+
+    def tearDown(self):
+        self.server.SHELL_TIMEOUT = self.original_timeout
+
+    async def run_command(self, command):
+        context = RecordingContext()
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        await asyncio.wait_for(self.server.execute_shell_command(command, context), self.bound)
+        return context.frames, loop.time() - started
+
+    def assert_finished(self, frames):
+        last = frames[-1]
+        if isinstance(last, (bytes, bytearray)):
+            last = self.server.loads(last)
+        self.assertEqual(last["type"], "shell_result")
+
+    async def test_detached_background_child_does_not_block(self):
+        # sh 立即退出，但脱离会话的子进程继续持有输出管道
+        frames, elapsed = await self.run_command("echo hi; setsid sleep 6 &")
+        self.assert_finished(frames)
+        self.assertIn({"type": "shell_stream", "stdout": "hi\n"}, frames)
+        self.assertLess(elapsed, self.server.SHELL_TIMEOUT)
+
+    async def test_setsid_child_survives_group_kill(self):
+        # 子进程在新会话中运行，超时终止进程组时不会被一起终止
+        frames, _ = await self.run_command(f"{sys.executable} -c 'import os, time; os.setsid(); time.sleep(6)'")
+        self.assert_finished(frames)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,6 +2,8 @@ import axios from 'axios'
 
 const API_BASE_URL = import.meta.env.VITE_API_URL || 'http://localhost:8000'
 
+const textDecoder = new TextDecoder()
+
 const apiClient = axios.create({
   baseURL: API_BASE_URL,
   headers: {
@@ -129,6 +131,7 @@ export class WSClient {
     const wsUrl = API_BASE_URL.replace('http', 'ws') + '/ws'
     
     this.ws = new WebSocket(wsUrl)
+    this.ws.binaryType = 'arraybuffer'
 
     this.ws.onopen = () => {
       console.log('WebSocket connected')
@@ -137,8 +140,10 @@ export class WSClient {
 
     this.ws.onmessage = (event) => {
       try {
-        const data = JSON.parse(event.data)
-        this.emit(data.type, data)
+        const raw = typeof event.data === 'string' ? event.data : textDecoder.decode(event.data)
+        const data = JSON.parse(raw)
+        const frames = data.type === 'batch' ? data.frames || [] : [data]
+        frames.forEach((frame: any) => this.emit(frame.type, frame))
       } catch (error) {
         console.error('Failed to parse WebSocket message:', error)
       }
@@ -12,6 +12,11 @@ import { Bot } from 'lucide-react'
 
 const API_BASE_URL = ''  // Use proxy in vite config
 
+const textDecoder = new TextDecoder()
+
+// 执行中的助手回复草稿，收到 assistant 结束帧后被最终消息替换
+const STREAMING_MESSAGE_ID = 'assistant-streaming'
+
 interface Message {
   id: string
   role: 'user' | 'assistant' | 'tool'
@@ -179,6 +184,8 @@ const ChatInterface: React.FC = () => {
       
       console.log('Connecting to WebSocket:', wsUrl)
       const websocket = new WebSocket(wsUrl)
+      // 服务器可能以二进制帧发送预序列化的 JSON
+      websocket.binaryType = 'arraybuffer'
       currentWebSocket = websocket
       
       websocket.onopen = () => {
@@ -216,7 +223,8 @@ const ChatInterface: React.FC = () => {
       
       websocket.onmessage = (event) => {
         try {
-          const data = JSON.parse(event.data)
+          const raw = typeof event.data === 'string' ? event.data : textDecoder.decode(event.data)
+          const data = JSON.parse(raw)
           // console.log('Received WebSocket message:', data)
           handleWebSocketMessage(data)
         } catch (error) {
@@ -375,6 +383,33 @@ const ChatInterface: React.FC = () => {
       messageIdef.current.add(id)
     }
     
+    // 服务器合并发送的多帧，按顺序逐帧处理
+    if (type === 'batch') {
+      (data.frames || []).forEach((frame: any) => handleWebSocketMessage(frame))
+      return
+    }
+    
+    // 连接建立时的合并帧：会话列表、初始消息和认证结果
+    if (type === 'init') {
+      handleWebSocketMessage({
+        type: 'sessions_list',
+        sessions: data.sessions,
+        current_session_id: data.current_session_id
+      })
+      handleWebSocketMessage({
+        type: 'session_messages',
+        session_id: data.session_id,
+        messages: data.initial_messages
+      })
+      if (data.auth) {
+        handleWebSocketMessage({
+          type: data.auth.success ? 'auth_success' : 'auth_error',
+          content: data.auth.content
+        })
+      }
+      return
+    }
+    
     // Handle authentication responses
     if (type === 'auth_success') {
       console.log('Authentication successful');
@@ -397,6 +432,12 @@ const ChatInterface: React.FC = () => {
       return
     }
     
+    if (type === 'shell_stream' || type === 'shell_result') {
+      // shell_stream 为执行中的增量输出，shell_result 为结束帧（含 exit_code）；
+      // stdout / stderr 均为可选字段，聊天界面不渲染 shell 输出
+      return
+    }
+    
     if (type === 'sessions_list') {
       // 更新会话列表
       setSessions(data.sessions || [])
@@ -475,6 +516,27 @@ const ChatInterface: React.FC = () => {
       return
     }
     
+    if (type === 'assistant_delta') {
+      // 执行过程中到达的回复文本，追加到草稿消息
+      setMessages(prev => {
+        const draft = prev.find(m => m.id === STREAMING_MESSAGE_ID)
+        if (!draft) {
+          return [...prev, {
+            id: STREAMING_MESSAGE_ID,
+            role: 'assistant' as const,
+            content: content || '',
+            timestamp: new Date(),
+            isStreaming: true
+          }]
+        }
+        return prev.map(m => m.id === STREAMING_MESSAGE_ID
+          ? { ...m, content: m.content ? `${m.content}\n\n${content || ''}` : (content || '') }
+          : m)
+      })
+      scrollToBottom()
+      return
+    }
+    
     if (type === 'assistant' || type === 'response') {
       const assistantMessage: Message = {
         id: id || `assistant-${Date.now()}`,
@@ -485,13 +547,14 @@ const ChatInterface: React.FC = () => {
         charge_result: data.charge_result
       }
       
-      // 使用函数式更新来避免消息重复
+      // 使用函数式更新来避免消息重复，同时移除草稿消息
       setMessages(prev => {
+        const rest = prev.filter(m => m.id !== STREAMING_MESSAGE_ID)
         // 检查是否已经存在相同ID的消息
-        if (prev.some(m => m.id === assistantMessage.id)) {
-          return prev
+        if (rest.some(m => m.id === assistantMessage.id)) {
+          return rest
         }
-        return [...prev, assistantMessage]
+        return [...rest, assistantMessage]
       })
       // 收到新消息后滚动到底部
       scrollToBottom()
@@ -510,7 +573,7 @@ const ChatInterface: React.FC = () => {
         content: `❌ 错误: ${content}`,
         timestamp: new Date()
       }
-      setMessages(prev => [...prev, errorMessage])
+      setMessages(prev => [...prev.filter(m => m.id !== STREAMING_MESSAGE_ID), errorMessage])
       setIsLoading(false)
     }
   }, [])
@@ -5,20 +5,27 @@
 """
 
 import os
+import re
+import codecs
+import signal
+import stat
+import importlib.util
 import asyncio
+import threading
 import json
 import logging
 from pathlib import Path
-from typing import Optional, Dict, List, Any
+from typing import Optional, Dict, List, Set, Any, Callable, Awaitable, Tuple
 from datetime import datetime
 from dataclasses import dataclass, field
+from operator import attrgetter
 import uuid
 import subprocess
 import shlex
 
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request, UploadFile, File, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse
+from fastapi.responses import FileResponse, PlainTextResponse, Response
 from starlette.middleware.base import BaseHTTPMiddleware
 import uvicorn
 import tempfile
@@ -38,6 +45,7 @@ from config.photon_config import PHOTON_CONFIG, CHARGING_ENABLED, FREE_TOKEN_QUO
 from core.message_types import MessageType, WebSocketMessage
 from core.state_machine import SessionState, StateMachine, SessionStateManager
 from core.event_handlers import EventProcessor
+from core.serialization import dumps, loads
 from services.message_service import MessageService
 
 # from bohrium_open_sdk import OpenSDK
@@ -58,8 +66,11 @@ if CHARGING_ENABLED:
 else:
     logger.info("光子收费服务已禁用")
 
+# 每个连接同时进行的会话初始化数量上限，防止客户端连续创建会话时无限制地并发初始化
+SESSION_INIT_CONCURRENCY = 4
 
-@dataclass
+
+@dataclass(slots=True)
 class Session:
     """Session model"""
     id: str
@@ -74,28 +85,46 @@ class Session:
             self.title = content[:30] + "..." if len(content) > 30 else content
     
     def to_dict(self) -> Dict[str, Any]:
-        """Convert session to dictionary"""
+        """Convert session to dictionary (datetimes are left for orjson to emit as ISO 8601)"""
         return {
             "id": self.id,
             "title": self.title,
-            "created_at": self.created_at.isoformat(),
-            "last_message_at": self.last_message_at.isoformat(),
+            "created_at": self.created_at,
+            "last_message_at": self.last_message_at,
             "message_count": self.message_count
         }
 
 
 class ConnectionContext:
     """每个WebSocket连接的独立上下文"""
+    # 每个连接一个实例，固定属性集合，省去实例 __dict__
+    __slots__ = (
+        "websocket", "sessions", "runner", "session_service", "artifact_service",
+        "runner_ready", "init_semaphore", "init_tasks", "current_session_id", "sessions_version", "sessions_frame",
+        "shell_state", "user_id", "app_access_key", "client_name", "is_authenticated",
+        "state_manager", "event_processor", "outbox", "writer_task", "message_service"
+    )
+    
     def __init__(self, websocket: WebSocket):
         self.websocket = websocket
         self.sessions: Dict[str, Session] = {}
-        self.runners: Dict[str, Runner] = {}
-        self.session_services: Dict[str, InMemorySessionService] = {}
-        self.artifact_services: Dict[str, InMemoryArtifactService] = {}
+        # 连接内所有会话共享一个 session service 和 runner，ADK 按 (app, user, session) 区分会话
+        self.runner: Optional[Runner] = None
+        self.session_service: Optional[InMemorySessionService] = None
+        self.artifact_service: Optional[InMemoryArtifactService] = None
+        # runner 初始化结束（成功或失败）时置位，处理消息前等待它而不是轮询
+        self.runner_ready: Dict[str, asyncio.Event] = {}
+        # 会话初始化的并发上限与进行中的任务，断开连接时取消
+        self.init_semaphore = asyncio.Semaphore(SESSION_INIT_CONCURRENCY)
+        self.init_tasks: Set[asyncio.Task] = set()
         self.current_session_id: Optional[str] = None
+        # 会话列表变更计数；与 current_session_id 一起决定缓存的 sessions_list 帧是否仍有效
+        self.sessions_version = 0
+        self.sessions_frame: Optional[Tuple[Tuple[int, Optional[str]], bytes]] = None
         self.shell_state: Dict[str, any] = {
             "cwd": os.getcwd(),
-            "env": os.environ.copy()
+            # None 表示子进程直接继承服务器进程的环境，每次启动命令时无需复制并重新编码整个环境
+            "env": None
         }
         # 为每个连接生成唯一的user_id
         self.user_id = f"user_{uuid.uuid4().hex[:8]}"
@@ -107,8 +136,32 @@ class ConnectionContext:
         self.state_manager = SessionStateManager()
         # 事件处理器
         self.event_processor = EventProcessor()
-        # 消息服务 - 传递WebSocket引用
-        self.message_service = MessageService(self.event_processor, websocket)
+        # 发送队列：所有出站帧先序列化入队，由单一写任务合并发送
+        self.outbox: asyncio.Queue = asyncio.Queue()
+        self.writer_task: Optional[asyncio.Task] = None
+        # 消息服务 - 传递WebSocket引用，工具状态帧同样经由发送队列
+        self.message_service = MessageService(self.event_processor, websocket, sender=self.enqueue)
+    
+    @property
+    def is_open(self) -> bool:
+        """写任务未结束，连接仍可发送"""
+        return self.writer_task is None or not self.writer_task.done()
+    
+    def enqueue(self, payload: Any):
+        """将消息序列化后放入发送队列；连接已断开时直接丢弃"""
+        if not self.is_open:
+            return
+        self.outbox.put_nowait(payload if isinstance(payload, bytes) else dumps(payload))
+    
+    async def flush(self):
+        """等待发送队列中已入队的帧全部写出；写任务结束时立即返回"""
+        if not self.is_open:
+            return
+        drained = asyncio.ensure_future(self.outbox.join())
+        try:
+            await asyncio.wait((drained, self.writer_task), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            drained.cancel()
 
 
 class SessionManager:
@@ -124,15 +177,22 @@ class SessionManager:
         
         # 先将会话添加到连接的会话列表
         context.sessions[session_id] = session
+        context.sessions_version += 1
+        context.runner_ready[session_id] = asyncio.Event()
         
         # 创建状态机
         state_machine = context.state_manager.create_session(session_id)
         
         # 异步创建 session service 和 runner
         task = asyncio.create_task(self._init_session_runner(context, session_id))
+        context.init_tasks.add(task)
+        task.add_done_callback(context.init_tasks.discard)
         
         # 添加错误处理回调
         def handle_init_error(future):
+            # 连接断开时被取消，无需记录
+            if future.cancelled():
+                return
             try:
                 future.result()
             except Exception as e:
@@ -144,50 +204,52 @@ class SessionManager:
         return session
     
     async def _init_session_runner(self, context: ConnectionContext, session_id: str):
-        """异步初始化会话的runner"""
-        try:
-            session_service = InMemorySessionService()
-            artifact_service = InMemoryArtifactService()
-            await session_service.create_session(
-                app_name=self.app_name,
-                user_id=context.user_id,
-                session_id=session_id
-            )
-            
-            runner = Runner(
-                agent=rootagent,
-                session_service=session_service,
-                artifact_service=artifact_service,
-                app_name=self.app_name
-            )
-            
-            context.session_services[session_id] = session_service
-            context.artifact_services[session_id] = artifact_service
-            context.runners[session_id] = runner
-            
-            # 更新状态机状态
-            state_machine = context.state_manager.get_session(session_id)
-            if state_machine:
-                state_machine.transition_to(SessionState.READY, reason="Runner initialized")
-            
-            # logger.info(f"Runner 初始化完成: {session_id}")
-            
-        except Exception as e:
-            logger.error(f"初始化Runner失败: {e}")
-            # 清理失败的会话
-            if session_id in context.sessions:
-                del context.sessions[session_id]
-            if session_id in context.session_services:
-                del context.session_services[session_id]
-            if session_id in context.artifact_services:
-                del context.artifact_services[session_id]
-            if session_id in context.runners:
-                del context.runners[session_id]
-            
-            # 更新状态机状态
-            state_machine = context.state_manager.get_session(session_id)
-            if state_machine:
-                state_machine.transition_to(SessionState.ERROR, reason=f"Runner initialization failed: {e}")
+        """异步在连接共享的 session service 中创建会话"""
+        async with context.init_semaphore:
+            try:
+                await context.session_service.create_session(
+                    app_name=self.app_name,
+                    user_id=context.user_id,
+                    session_id=session_id
+                )
+                
+                # 初始化期间会话已被删除
+                if session_id not in context.sessions:
+                    await context.session_service.delete_session(
+                        app_name=self.app_name,
+                        user_id=context.user_id,
+                        session_id=session_id
+                    )
+                    return
+                
+                # 更新状态机状态
+                state_machine = context.state_manager.get_session(session_id)
+                if state_machine:
+                    state_machine.transition_to(SessionState.READY, reason="Runner initialized")
+                
+                # 唤醒等待该会话的消息处理
+                ready = context.runner_ready.get(session_id)
+                if ready is not None:
+                    ready.set()
+                
+                # logger.info(f"Runner 初始化完成: {session_id}")
+                
+            except Exception as e:
+                logger.error(f"初始化Runner失败: {e}")
+                # 清理失败的会话
+                if session_id in context.sessions:
+                    del context.sessions[session_id]
+                    context.sessions_version += 1
+                
+                # 更新状态机状态
+                state_machine = context.state_manager.get_session(session_id)
+                if state_machine:
+                    state_machine.transition_to(SessionState.ERROR, reason=f"Runner initialization failed: {e}")
+                
+                # 唤醒等待该会话的消息处理，由其报告初始化失败
+                ready = context.runner_ready.pop(session_id, None)
+                if ready is not None:
+                    ready.set()
     
     def get_session(self, context: ConnectionContext, session_id: str) -> Optional[Session]:
         """获取会话"""
@@ -197,16 +259,22 @@ class SessionManager:
         """获取连接的所有会话列表"""
         return list(context.sessions.values())
     
-    def delete_session(self, context: ConnectionContext, session_id: str) -> bool:
+    async def delete_session(self, context: ConnectionContext, session_id: str) -> bool:
         """删除会话"""
         if session_id in context.sessions:
             del context.sessions[session_id]
-            if session_id in context.runners:
-                del context.runners[session_id]
-            if session_id in context.session_services:
-                del context.session_services[session_id]
-            if session_id in context.artifact_services:
-                del context.artifact_services[session_id]
+            context.sessions_version += 1
+            ready = context.runner_ready.pop(session_id, None)
+            # 共享的 session service 中同步删除，初始化未完成或失败时其中还没有该会话
+            if ready is not None and ready.is_set():
+                try:
+                    await context.session_service.delete_session(
+                        app_name=self.app_name,
+                        user_id=context.user_id,
+                        session_id=session_id
+                    )
+                except Exception as e:
+                    logger.warning(f"删除 ADK 会话失败: {e}")
             
             # 清理状态机
             context.state_manager.remove_session(session_id)
@@ -219,7 +287,7 @@ class SessionManager:
         """切换当前会话"""
         if session_id in context.sessions:
             context.current_session_id = session_id
-            logger.info(f"用户 {context.user_id} 切换到会话: {session_id}")
+            logger.debug("用户 %s 切换到会话: %s", context.user_id, session_id)
             return True
         return False
     
@@ -235,9 +303,19 @@ class SessionManager:
             context.app_access_key = app_access_key
             context.client_name = client_name or "WebClient"
             context.is_authenticated = True
-            logger.info(f"用户 {context.user_id} 通过查询参数认证成功, AccessKey: {app_access_key}")
+            logger.debug("用户 %s 通过查询参数认证成功, AccessKey: %s...", context.user_id, app_access_key[:8])
+        
+        context.session_service = InMemorySessionService()
+        context.artifact_service = InMemoryArtifactService()
+        context.runner = Runner(
+            agent=rootagent,
+            session_service=context.session_service,
+            artifact_service=context.artifact_service,
+            app_name=self.app_name
+        )
         
         self.active_connections[websocket] = context
+        context.writer_task = asyncio.create_task(self._outbox_writer(context))
         
         # logger.info(f"新用户连接: {context.user_id}")
         
@@ -245,37 +323,69 @@ class SessionManager:
         session = await self.create_session(context)
         context.current_session_id = session.id
             
-        # 发送初始会话信息
-        await self.send_sessions_list(context)
-        await self.send_session_messages(context, session.id)
-        
-        # 如果通过查询参数认证成功，发送认证成功消息
-        if app_access_key:
-            await websocket.send_json({
-                "type": "auth_success",
-                "content": "认证成功"
-            })
+        # 将会话列表、历史消息和认证结果合并为一帧发送，避免冷连接上的多次写入
+        context.enqueue({
+            "type": "init",
+            "sessions": self._sessions_data(context),
+            "current_session_id": context.current_session_id,
+            "session_id": session.id,
+            "initial_messages": context.message_service.get_message_history(session.id),
+            # 如果通过查询参数认证成功，附带认证成功消息
+            "auth": {"success": True, "content": "认证成功"} if app_access_key else None
+        })
         
     def disconnect_client(self, websocket: WebSocket):
         """断开客户端连接"""
         if websocket in self.active_connections:
             context = self.active_connections[websocket]
             logger.info(f"用户断开连接: {context.user_id}")
+            if context.writer_task:
+                context.writer_task.cancel()
+            # 取消尚未完成的会话初始化
+            for task in context.init_tasks:
+                task.cancel()
             # 清理该连接的所有资源
             del self.active_connections[websocket]
     
+    async def _outbox_writer(self, context: ConnectionContext):
+        """连接的写任务：取出队列中已积压的所有帧，多帧时合并为一个 batch 帧发送"""
+        queue = context.outbox
+        try:
+            while True:
+                frames = [await queue.get()]
+                while True:
+                    try:
+                        frames.append(queue.get_nowait())
+                    except asyncio.QueueEmpty:
+                        break
+                
+                if len(frames) == 1:
+                    data = frames[0]
+                else:
+                    data = b'{"type":"batch","frames":[' + b",".join(frames) + b"]}"
+                await context.websocket.send_bytes(data)
+                for _ in frames:
+                    queue.task_done()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"发送队列写入失败: {e}")
+    
+    def _sessions_data(self, context: ConnectionContext) -> List[Dict[str, Any]]:
+        """构建会话列表数据"""
+        return [session.to_dict() for session in context.sessions.values()]
+    
     async def send_sessions_list(self, context: ConnectionContext):
-        """发送会话列表到客户端"""
-        sessions_data = []
-        for session in context.sessions.values():
-            sessions_data.append(session.to_dict())
-        
-        # 使用简单格式发送消息
-        await context.websocket.send_json({
-            "type": "sessions_list",
-            "sessions": sessions_data,
-            "current_session_id": context.current_session_id
-        })
+        """发送会话列表到客户端；会话列表未变化时复用已序列化的帧"""
+        key = (context.sessions_version, context.current_session_id)
+        cached = context.sessions_frame
+        if cached is None or cached[0] != key:
+            cached = context.sessions_frame = (key, dumps({
+                "type": "sessions_list",
+                "sessions": self._sessions_data(context),
+                "current_session_id": context.current_session_id
+            }))
+        context.enqueue(cached[1])
     
     async def send_session_messages(self, context: ConnectionContext, session_id: str):
         """发送会话的历史消息"""
@@ -285,55 +395,49 @@ class SessionManager:
             return
             
         # logger.info(f"准备发送会话 {session_id} 的消息历史")
-        messages_data = context.message_service.get_message_history(session_id)
-        # logger.info(f"会话 {session_id} 获取到 {len(messages_data)} 条消息")
-        
-        # 使用简单格式发送消息
-        await context.websocket.send_json({
-            "type": "session_messages",
-            "session_id": session_id,
-            "messages": messages_data
-        })
+        # 消息历史未变化时直接复用已序列化的帧
+        context.enqueue(context.message_service.get_serialized_history(session_id))
         # logger.info(f"会话 {session_id} 的消息历史已发送到前端")
     
     async def send_to_connection(self, context: ConnectionContext, message: WebSocketMessage):
         """发送消息到特定连接"""
-        try:
-            # 直接发送消息数据，而不是WebSocketMessage包装
-            await context.websocket.send_json(message.to_dict())
-        except Exception as e:
-            logger.error(f"发送消息失败: {e}")
-            self.disconnect_client(context.websocket)
+        # 直接发送消息数据，而不是WebSocketMessage包装
+        context.enqueue(message.to_dict())
     
     async def process_message(self, context: ConnectionContext, message: str):
         """处理用户消息 - 重构后的版本"""
         if not context.current_session_id:
             # 发送错误消息 - 使用简单格式
-            await context.websocket.send_json({
+            context.enqueue({
                 "type": "error",
                 "content": "没有活动的会话"
             })
             return
             
         # 等待runner初始化完成
-        retry_count = 0
-        while context.current_session_id not in context.runners and retry_count < 50:
-            await asyncio.sleep(0.1)
-            retry_count += 1
+        ready = context.runner_ready.get(context.current_session_id)
+        if ready is not None and not ready.is_set():
+            try:
+                await asyncio.wait_for(ready.wait(), timeout=5.0)
+            except asyncio.TimeoutError:
+                pass
             
-        if context.current_session_id not in context.runners:
+        # 初始化失败时事件已被移除
+        ready = context.runner_ready.get(context.current_session_id)
+        if ready is None or not ready.is_set():
             # 发送错误消息 - 使用简单格式
-            await context.websocket.send_json({
+            context.enqueue({
                 "type": "error",
                 "content": "会话初始化失败，请重试"
             })
             return
             
         session = context.sessions[context.current_session_id]
-        runner = context.runners[context.current_session_id]
+        runner = context.runner
         
         # 更新会话标题
         session.update_title(message)
+        context.sessions_version += 1
         
         # 使用消息服务处理消息
         try:
@@ -365,22 +469,25 @@ class SessionManager:
 
                     if CHARGING_ENABLED:
                         if not response_message["charge_result"]['success']:
-                            await context.websocket.send_json({
+                            context.enqueue({
                                     "type": "charge_failed",
                                     "content": f"收费失败: {result['charge_result'].get('message', '未知错误')}，连接将断开",
                                 })
+                            # 关闭前先写出队列中的帧，保证客户端收到收费失败消息
+                            await context.flush()
                             await context.websocket.close(code=4001, reason="Charge failed")
                             self.disconnect_client(context.websocket)
                             return
                 
-                await context.websocket.send_json(response_message)
+                context.enqueue(response_message)
                 session.message_count = context.message_service.get_message_count(context.current_session_id)
                 session.last_message_at = datetime.now()
+                context.sessions_version += 1
                 
                 if state_machine:
                     state_machine.transition_to(SessionState.READY, reason="Message processing completed")
             else:
-                await context.websocket.send_json({
+                context.enqueue({
                     "type": "error",
                     "content": f"处理消息失败: {result['error']}"
                 })
@@ -390,18 +497,17 @@ class SessionManager:
                     state_machine.transition_to(SessionState.ERROR, reason=f"Message processing failed: {result['error']}")
             
             # 发送完成标记 - 使用简单格式
-            await context.websocket.send_json({
+            context.enqueue({
                 "type": "complete",
                 "content": ""
             })
                     
         except Exception as e:
-            import traceback
-            error_details = traceback.format_exc()
-            logger.error(f"处理消息时出错: {e}\n{error_details}")
+            # 堆栈仅在 DEBUG 级别输出，故障频发时避免反复格式化 traceback
+            logger.error("处理消息时出错: %s", e, exc_info=logger.isEnabledFor(logging.DEBUG))
             
             # 发送错误消息 - 使用简单格式
-            await context.websocket.send_json({
+            context.enqueue({
                 "type": "error",
                 "content": f"处理消息失败: {str(e)}"
             })
@@ -415,27 +521,44 @@ class SessionManager:
 # 创建全局管理器
 manager = SessionManager()
 
+
+class JSONResponse(Response):
+    """使用 orjson 序列化的 JSON 响应，与 WebSocket 帧共用 core.serialization.dumps"""
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
 # FastAPI 应用
 app = FastAPI(title="Refactored Agent WebSocket Server")
 
 # 获取服务器配置
 server_config = agentconfig.get_server_config()
 allowed_hosts = server_config.get("allowedHosts", ["localhost", "127.0.0.1", "0.0.0.0"])
+# 主机校验每个请求都会执行，启动时转为集合以便常数时间查找
+allowed_hosts_set = frozenset(allowed_hosts)
+
+# 配置启动时加载后不再变化，请求处理中用到的部分预先取出
+agent_info = agentconfig.config.get("agent", {})
+agent_name = agent_info.get("name", "Agent")
+files_config = agentconfig.get_files_config()
+output_directory = files_config.get("outputDirectory", "output")
+# /api/config 的响应体固定不变，启动时序列化一次
+config_payload = dumps({
+    "agent": agent_info,
+    "ui": agentconfig.get_ui_config(),
+    "files": files_config,
+    "websocket": agentconfig.get_websocket_config()
+})
 
-# 构建允许的 CORS origins
-allowed_origins = []
-for host in allowed_hosts:
-    allowed_origins.extend([
-        f"http://{host}:*",
-        f"https://{host}:*",
-        f"http://{host}",
-        f"https://{host}"
-    ])
+# 构建允许的 CORS origins：启动时编译为单个正则，任意端口均可匹配
+allowed_origin_regex = r"^https?://(" + "|".join(re.escape(host) for host in allowed_hosts) + r")(:\d+)?$"
 
 # 添加 CORS 中间件
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=allowed_origins,
+    allow_origin_regex=allowed_origin_regex,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
@@ -444,8 +567,8 @@ app.add_middleware(
 # Host 验证中间件
 class HostValidationMiddleware(BaseHTTPMiddleware):
     async def dispatch(self, request: Request, call_next):
-        host = request.headers.get("host", "").split(":")[0]
-        if host and host not in allowed_hosts:
+        host = request.headers.get("host", "").partition(":")[0]
+        if host and host not in allowed_hosts_set:
             return PlainTextResponse(
                 content=f"Host '{host}' is not allowed",
                 status_code=403
@@ -456,6 +579,105 @@ class HostValidationMiddleware(BaseHTTPMiddleware):
 app.add_middleware(HostValidationMiddleware)
 
 
+# WebSocket 消息处理函数
+async def handle_user_message(context: ConnectionContext, data: Dict[str, Any]):
+    """处理用户聊天消息"""
+    content = data.get("content", "").strip()
+    if content:
+        await manager.process_message(context, content)
+
+
+async def handle_create_session(context: ConnectionContext, data: Dict[str, Any]):
+    """创建新会话"""
+    session = await manager.create_session(context)
+    await manager.switch_session(context, session.id)
+    await manager.send_sessions_list(context)
+    await manager.send_session_messages(context, session.id)
+
+
+async def handle_switch_session(context: ConnectionContext, data: Dict[str, Any]):
+    """切换会话"""
+    session_id = data.get("session_id")
+    if session_id and await manager.switch_session(context, session_id):
+        await manager.send_session_messages(context, session_id)
+    else:
+        # 使用简单格式发送错误消息
+        context.enqueue({
+            "type": "error",
+            "content": "会话不存在"
+        })
+
+
+async def handle_get_sessions(context: ConnectionContext, data: Dict[str, Any]):
+    """获取会话列表"""
+    await manager.send_sessions_list(context)
+
+
+async def handle_delete_session(context: ConnectionContext, data: Dict[str, Any]):
+    """删除会话"""
+    session_id = data.get("session_id")
+    if session_id and await manager.delete_session(context, session_id):
+        # 如果删除的是当前会话，切换到其他会话或创建新会话
+        if session_id == context.current_session_id:
+            if context.sessions:
+                # 切换到第一个可用会话
+                first_session_id = next(iter(context.sessions))
+                await manager.switch_session(context, first_session_id)
+            else:
+                # 创建新会话
+                session = await manager.create_session(context)
+                await manager.switch_session(context, session.id)
+        await manager.send_sessions_list(context)
+    else:
+        # 使用简单格式发送错误消息
+        context.enqueue({
+            "type": "error",
+            "content": "删除会话失败"
+        })
+
+
+async def handle_authenticate(context: ConnectionContext, data: Dict[str, Any]):
+    """处理用户认证信息"""
+    app_access_key = data.get("appAccessKey", "").strip()
+    client_name = data.get("clientName", "").strip()
+    
+    if app_access_key:
+        context.app_access_key = app_access_key
+        context.client_name = client_name or "WebClient"
+        context.is_authenticated = True
+        logger.info(f"用户 {context.user_id} 认证成功，AccessKey: {app_access_key[:8]}...")
+        
+        context.enqueue({
+            "type": "auth_success",
+            "content": "认证成功"
+        })
+    else:
+        logger.warning(f"用户 {context.user_id} 认证失败：缺少AccessKey")
+        context.enqueue({
+            "type": "auth_error",
+            "content": "认证失败：缺少AccessKey"
+        })
+
+
+async def handle_shell_command(context: ConnectionContext, data: Dict[str, Any]):
+    """执行 shell 命令"""
+    command = data.get("command", "").strip()
+    if command:
+        await execute_shell_command(command, context)
+
+
+# 消息类型 -> 处理函数，每帧一次字典查找完成分发
+MESSAGE_HANDLERS: Dict[str, Callable[[ConnectionContext, Dict[str, Any]], Awaitable[None]]] = {
+    "message": handle_user_message,
+    "create_session": handle_create_session,
+    "switch_session": handle_switch_session,
+    "get_sessions": handle_get_sessions,
+    "delete_session": handle_delete_session,
+    "authenticate": handle_authenticate,
+    "shell_command": handle_shell_command,
+}
+
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     """WebSocket 端点"""
@@ -463,8 +685,9 @@ async def websocket_endpoint(websocket: WebSocket):
     query_params = websocket.query_params
     app_access_key = query_params.get("appAccessKey")
     client_name = query_params.get("clientName")
-    logger.info(f"app_access_key from websocket: {app_access_key}")
-    logger.info(f"client_name from websocket: {client_name}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("app_access_key from websocket: %s", app_access_key[:8] + "..." if app_access_key else None)
+        logger.debug("client_name from websocket: %s", client_name)
     await manager.connect_client(websocket, app_access_key, client_name)
     
     # 获取该连接的上下文
@@ -476,85 +699,27 @@ async def websocket_endpoint(websocket: WebSocket):
         
     try:
         while True:
-            data = await websocket.receive_json()
+            # orjson 解析，格式错误的帧在分发前直接拒绝，不再断开连接
+            try:
+                data = loads(await websocket.receive_text())
+            except ValueError:
+                data = None
+            if not isinstance(data, dict):
+                context.enqueue({
+                    "type": "error",
+                    "content": "无效的消息格式"
+                })
+                continue
             message_type = data.get("type")
             
-            if message_type == "message":
-                content = data.get("content", "").strip()
-                if content:
-                    await manager.process_message(context, content)
-                    
-            elif message_type == "create_session":
-                # 创建新会话
-                session = await manager.create_session(context)
-                await manager.switch_session(context, session.id)
-                await manager.send_sessions_list(context)
-                await manager.send_session_messages(context, session.id)
-                
-            elif message_type == "switch_session":
-                # 切换会话
-                session_id = data.get("session_id")
-                if session_id and await manager.switch_session(context, session_id):
-                    await manager.send_session_messages(context, session_id)
-                else:
-                    # 使用简单格式发送错误消息
-                    await websocket.send_json({
-                        "type": "error",
-                        "content": "会话不存在"
-                    })
-                    
-            elif message_type == "get_sessions":
-                # 获取会话列表
-                await manager.send_sessions_list(context)
-                
-            elif message_type == "delete_session":
-                # 删除会话
-                session_id = data.get("session_id")
-                if session_id and manager.delete_session(context, session_id):
-                    # 如果删除的是当前会话，切换到其他会话或创建新会话
-                    if session_id == context.current_session_id:
-                        if context.sessions:
-                            # 切换到第一个可用会话
-                            first_session_id = list(context.sessions.keys())[0]
-                            await manager.switch_session(context, first_session_id)
-                        else:
-                            # 创建新会话
-                            session = await manager.create_session(context)
-                            await manager.switch_session(context, session.id)
-                    await manager.send_sessions_list(context)
-                else:
-                    # 使用简单格式发送错误消息
-                    await websocket.send_json({
-                        "type": "error",
-                        "content": "删除会话失败"
-                    })
-                    
-            elif message_type == "authenticate":
-                # 处理用户认证信息
-                app_access_key = data.get("appAccessKey", "").strip()
-                client_name = data.get("clientName", "").strip()
-                
-                if app_access_key:
-                    context.app_access_key = app_access_key
-                    context.client_name = client_name or "WebClient"
-                    context.is_authenticated = True
-                    logger.info(f"用户 {context.user_id} 认证成功，AccessKey: {app_access_key[:8]}...")
-                    
-                    await websocket.send_json({
-                        "type": "auth_success",
-                        "content": "认证成功"
-                    })
-                else:
-                    logger.warning(f"用户 {context.user_id} 认证失败：缺少AccessKey")
-                    await websocket.send_json({
-                        "type": "auth_error",
-                        "content": "认证失败：缺少AccessKey"
-                    })
-                    
-            elif message_type == "shell_command":
-                command = data.get("command", "").strip()
-                if command:
-                    await execute_shell_command(command, context)
+            handler = MESSAGE_HANDLERS.get(message_type)
+            if handler is None:
+                context.enqueue({
+                    "type": "error",
+                    "content": f"未知的消息类型: {message_type}"
+                })
+                continue
+            await handler(context, data)
                 
     except WebSocketDisconnect:
         manager.disconnect_client(websocket)
@@ -564,53 +729,151 @@ async def websocket_endpoint(websocket: WebSocket):
 
 
 # 文件相关API
+# 文件树和文件内容接口只允许访问输出目录内的路径
+output_root = Path(output_directory).resolve()
+# 文件树缓存上限：path 参数来自客户端，需要限制缓存条目数
+FILE_TREE_CACHE_SIZE = 32
+# 解析后的绝对路径 -> (树中每个目录的 (路径, mtime_ns), 序列化后的 JSON)
+# 目录内增删、重命名条目都会更新该目录的 mtime，所有目录 mtime 不变即可直接复用上次结果
+_tree_cache: Dict[str, Tuple[Tuple[Tuple[str, int], ...], bytes]] = {}
+
+
+# 目录条目的排序键
+_entry_name = attrgetter("name")
+
+
+def _build_file_tree(directory: str, dir_mtimes: List[Tuple[str, int]]) -> List[Dict[str, Any]]:
+    """递归构建文件树，同时记录经过的每个目录的 mtime"""
+    items = []
+    try:
+        # 先取 mtime 再列目录：列目录期间发生的修改会使下次校验失败而重建
+        dir_mtimes.append((directory, os.stat(directory).st_mtime_ns))
+        # relpath 需要规范化并比较两条绝对路径，开销比 scandir 本身还大；
+        # 每个目录只算一次前缀，条目路径直接拼接
+        relative_dir = os.path.relpath(directory)
+        prefix = "" if relative_dir == os.curdir else relative_dir + os.sep
+        # scandir 返回的 DirEntry 自带文件类型，判断目录/文件不再逐项 stat；隐藏文件在排序前就过滤掉
+        with os.scandir(directory) as it:
+            entries = [entry for entry in it if not entry.name.startswith('.')]
+        entries.sort(key=_entry_name)
+        for entry in entries:
+            name = entry.name
+            # 不跟随符号链接：指向输出目录之外（或指向上级目录形成环）的链接不会被遍历，
+            # 链接本身按文件列出，大小取链接自身的 lstat
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+                size = None if is_dir else entry.stat(follow_symlinks=False).st_size
+            except OSError:
+                # 遍历期间被删除等情况，跳过该条目而不是让整棵树失败
+                continue
+            node = {
+                "name": name,
+                "path": prefix + name,
+                "type": "directory" if is_dir else "file"
+            }
+            
+            if is_dir:
+                node["children"] = _build_file_tree(entry.path, dir_mtimes)
+            else:
+                node["size"] = size
+                
+            items.append(node)
+    except OSError:
+        # 目录无权限或已被删除时返回已收集的条目
+        pass
+    return items
+
+
+def _tree_unchanged(dir_mtimes: Tuple[Tuple[str, int], ...]) -> bool:
+    """每个目录一次 stat 校验缓存，无需重新列目录和 stat 文件"""
+    try:
+        return all(os.stat(directory).st_mtime_ns == mtime for directory, mtime in dir_mtimes)
+    except OSError:
+        return False
+
+
+def _scan_file_tree(path: str) -> Optional[Tuple[Tuple[Tuple[str, int], ...], bytes]]:
+    """遍历并序列化文件树，返回 (目录 mtime 签名, JSON)；路径不是目录时返回 None"""
+    if not os.path.isdir(path):
+        return None
+    
+    dir_mtimes: List[Tuple[str, int]] = []
+    body = dumps(_build_file_tree(path, dir_mtimes))
+    if not dir_mtimes:
+        # 遍历开始前目录已被删除：空签名会让缓存永远有效，按不存在处理
+        return None
+    return tuple(dir_mtimes), body
+
+
 @app.get("/api/files/tree")
 async def get_file_tree(path: str = None):
     """获取文件树结构"""
     try:
         if path is None:
-            path = agentconfig.get_files_config().get("outputDirectory", "output")
+            path = output_directory
         
-        base_path = Path(path)
-        if not base_path.exists():
-            base_path.mkdir(parents=True, exist_ok=True)
-            
-        def build_tree(directory: Path):
-            items = []
-            try:
-                for item in sorted(directory.iterdir()):
-                    if item.name.startswith('.'):
-                        continue
-                        
-                    node = {
-                        "name": item.name,
-                        "path": str(item.relative_to(".")),
-                        "type": "directory" if item.is_dir() else "file"
-                    }
-                    
-                    if item.is_dir():
-                        node["children"] = build_tree(item)
-                    else:
-                        node["size"] = item.stat().st_size
-                        
-                    items.append(node)
-            except PermissionError:
-                pass
-            return items
+        # 与文件内容接口相同：解析符号链接和 .. 后必须仍位于输出目录内
+        resolved = Path(path).resolve()
+        if not resolved.is_relative_to(output_root):
+            return JSONResponse(
+                content={"error": "禁止访问该路径"},
+                status_code=403
+            )
+        path = str(resolved)
+        
+        # 目录遍历和 stat 都是阻塞调用，放到线程池执行，避免大目录卡住事件循环上的所有连接；
+        # 缓存字典只在事件循环线程中读写
+        cached = _tree_cache.get(path)
+        if cached is not None and await asyncio.to_thread(_tree_unchanged, cached[0]):
+            return Response(content=cached[1], media_type="application/json")
+        
+        scanned = await asyncio.to_thread(_scan_file_tree, path)
+        if scanned is None:
+            # GET 请求不创建目录；输出目录尚未生成时视为空树
+            if resolved == output_root:
+                return JSONResponse(content=[])
+            return JSONResponse(
+                content={"error": "目录未找到"},
+                status_code=404
+            )
+        dir_mtimes, body = scanned
         
-        return JSONResponse(content=build_tree(base_path))
+        _tree_cache.pop(path, None)
+        if len(_tree_cache) >= FILE_TREE_CACHE_SIZE:
+            # dict 保持插入顺序，淘汰最早写入的条目
+            del _tree_cache[next(iter(_tree_cache))]
+        _tree_cache[path] = (dir_mtimes, body)
+        return Response(content=body, media_type="application/json")
         
     except Exception as e:
         logger.error(f"获取文件树错误: {e}")
         return JSONResponse(content=[], status_code=500)
 
 
+# 按文本返回的文件后缀
+TEXT_FILE_SUFFIXES = frozenset({'.json', '.txt', '.csv', '.py', '.js', '.ts', '.log', '.xml', '.yaml', '.yml'})
+# 文本文件的响应类型，与原先 PlainTextResponse 一致
+TEXT_FILE_MEDIA_TYPE = "text/plain; charset=utf-8"
+
+
 @app.get("/api/files/{file_path:path}")
 async def get_file_content(file_path: str):
     """获取文件内容"""
     try:
-        file = Path(file_path)
-        if not file.exists() or not file.is_file():
+        # 解析符号链接和 .. 后必须仍位于输出目录内
+        file = Path(file_path).resolve()
+        if not file.is_relative_to(output_root):
+            return JSONResponse(
+                content={"error": "禁止访问该路径"},
+                status_code=403
+            )
+        
+        # 一次 stat 同时判断存在性和文件类型，结果交给 FileResponse 复用
+        try:
+            file_stat = file.stat()
+        except OSError:
+            file_stat = None
+        if file_stat is None or not stat.S_ISREG(file_stat.st_mode):
             return JSONResponse(
                 content={"error": "文件未找到"},
                 status_code=404
@@ -619,19 +882,13 @@ async def get_file_content(file_path: str):
         # 判断文件类型
         suffix = file.suffix.lower()
         
-        # 文本文件
-        if suffix in ['.json', '.txt', '.csv', '.py', '.js', '.ts', '.log', '.xml', '.yaml', '.yml']:
-            try:
-                content = file.read_text(encoding='utf-8')
-                return PlainTextResponse(content)
-            except UnicodeDecodeError:
-                return JSONResponse(
-                    content={"error": "无法解码文件内容"},
-                    status_code=400
-                )
+        # 文本文件：与二进制文件一样由 FileResponse 分块发送，不整体读入内存；
+        # 统一按纯文本返回，浏览器不会执行或渲染其中的 js/xml 等内容
+        if suffix in TEXT_FILE_SUFFIXES:
+            return FileResponse(file, media_type=TEXT_FILE_MEDIA_TYPE, stat_result=file_stat)
         else:
             # 二进制文件
-            return FileResponse(file)
+            return FileResponse(file, stat_result=file_stat)
             
     except Exception as e:
         logger.error(f"读取文件错误: {e}")
@@ -641,31 +898,64 @@ async def get_file_content(file_path: str):
         )
 
 
+# 根路径与上传服务正常时的响应内容固定，启动时序列化一次
+root_payload = dumps({
+    "message": f"{agent_name} 重构后的 WebSocket 服务器正在运行",
+    "mode": "session",
+    "architecture": "modular",
+    "endpoints": {
+        "websocket": "/ws",
+        "files": "/api/files",
+        "file_tree": "/api/files/tree",
+        "config": "/api/config"
+    }
+})
+upload_available_payload = dumps({
+    "success": True,
+    "status": "available",
+    "message": "上传服务正常运行"
+})
+
+
 @app.get("/")
 async def root():
     """根路径"""
-    return {
-        "message": f"{agentconfig.config.get('agent', {}).get('name', 'Agent')} 重构后的 WebSocket 服务器正在运行",
-        "mode": "session",
-        "architecture": "modular",
-        "endpoints": {
-            "websocket": "/ws",
-            "files": "/api/files",
-            "file_tree": "/api/files/tree",
-            "config": "/api/config"
-        }
-    }
+    return Response(content=root_payload, media_type="application/json")
 
 
 @app.get("/api/config")
 async def get_config():
     """获取前端配置信息"""
-    return JSONResponse(content={
-        "agent": agentconfig.config.get("agent", {}),
-        "ui": agentconfig.get_ui_config(),
-        "files": agentconfig.get_files_config(),
-        "websocket": agentconfig.get_websocket_config()
-    })
+    return Response(content=config_payload, media_type="application/json")
+
+
+# 允许上传的文件类型
+ALLOWED_UPLOAD_EXTENSIONS = frozenset({'.xyz', '.mol', '.sdf', '.pdb', '.txt', '.json', '.csv'})
+# 上传文件每次读取的块大小
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+
+# HTTP 存储服务实例，首次使用时创建后复用：构造时会初始化存储插件（读取配置、获取令牌等）
+upload_storage = None
+# 存储插件持有客户端和令牌状态（如 BohriumStorage 过期时会重新获取令牌并改写 self.token），
+# 没有线程安全保证：在线程池中对共享实例的调用必须持有该锁
+upload_storage_lock = threading.Lock()
+
+
+def get_upload_storage():
+    """获取 HTTP 存储服务实例，创建失败时下次调用重试。
+    只在事件循环线程中调用（中间没有 await），因此不会并发创建多个实例"""
+    global upload_storage
+    if upload_storage is None:
+        from dp.agent.server.storage.http_storage import HTTPStorage
+        upload_storage = HTTPStorage()
+    return upload_storage
+
+
+def _upload_to_storage(storage, file_key: str, file_path: str) -> str:
+    """在线程池中调用共享存储实例上传文件；实例不是线程安全的，同一时间只允许一个上传"""
+    with upload_storage_lock:
+        return storage._upload(file_key, file_path)
 
 
 @app.post("/api/upload")
@@ -673,44 +963,42 @@ async def upload_file(file: UploadFile = File(...)):
     """文件上传API端点"""
     try:
         # 验证文件类型
-        allowed_extensions = {'.xyz', '.mol', '.sdf', '.pdb', '.txt', '.json', '.csv'}
-        file_extension = '.' + file.filename.split('.')[-1].lower() if file.filename and '.' in file.filename else ''
+        file_extension = os.path.splitext(file.filename or '')[1].lower()
         
-        if file_extension not in allowed_extensions:
+        if file_extension not in ALLOWED_UPLOAD_EXTENSIONS:
             raise HTTPException(
                 status_code=400, 
-                detail=f"不支持的文件类型。支持的格式: {', '.join(allowed_extensions)}"
+                detail=f"不支持的文件类型。支持的格式: {', '.join(ALLOWED_UPLOAD_EXTENSIONS)}"
             )
         
         # 验证文件大小 (10MB限制)
         max_size = 10 * 1024 * 1024  # 10MB
-        file_content = await file.read()
-        if len(file_content) > max_size:
-            raise HTTPException(
-                status_code=400,
-                detail="文件大小超过10MB限制"
-            )
         
-        # 重置文件指针
-        await file.seek(0)
-        
-        # 创建临时文件
-        with tempfile.NamedTemporaryFile(delete=False, suffix=file_extension) as temp_file:
-            temp_file.write(file_content)
-            temp_file_path = temp_file.name
+        # 分块复制到临时文件，边写边检查大小，不在内存中保留整个文件
+        temp_file = tempfile.NamedTemporaryFile(delete=False, suffix=file_extension)
+        temp_file_path = temp_file.name
         
         try:
-            # 使用HTTP存储服务上传到bohr
-            from dp.agent.server.storage.http_storage import HTTPStorage
+            size = 0
+            with temp_file:
+                while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > max_size:
+                        raise HTTPException(
+                            status_code=400,
+                            detail="文件大小超过10MB限制"
+                        )
+                    temp_file.write(chunk)
             
-            # 初始化HTTP存储
-            storage = HTTPStorage()
+            # 使用HTTP存储服务上传到bohr
+            storage = get_upload_storage()
             
-            # 生成唯一的文件键
-            file_key = f"uploads/{uuid.uuid4()}/{file.filename}"
+            # 生成唯一的文件键：按 uuid 前缀分两级目录，避免所有上传堆在同一前缀下
+            upload_id = uuid.uuid4().hex
+            file_key = f"uploads/{upload_id[:2]}/{upload_id[2:4]}/{upload_id}/{file.filename}"
             
-            # 上传文件
-            upload_result = storage._upload(file_key, temp_file_path)
+            # 上传文件：存储插件使用同步 HTTP 请求，放到线程池执行，上传期间事件循环继续服务其他连接
+            upload_result = await asyncio.to_thread(_upload_to_storage, storage, file_key, temp_file_path)
             
             # 构建完整的URL
             if upload_result:
@@ -727,7 +1015,7 @@ async def upload_file(file: UploadFile = File(...)):
                     "filename": file.filename,
                     "url": upload_url,
                     "key": file_key,
-                    "size": len(file_content),
+                    "size": size,
                     "type": file_extension
                 })
             else:
@@ -751,14 +1039,9 @@ async def upload_file(file: UploadFile = File(...)):
 async def get_upload_status():
     """获取上传服务状态"""
     try:
-        from dp.agent.server.storage.http_storage import HTTPStorage
-        storage = HTTPStorage()
+        get_upload_storage()
         
-        return JSONResponse(content={
-            "success": True,
-            "status": "available",
-            "message": "上传服务正常运行"
-        })
+        return Response(content=upload_available_payload, media_type="application/json")
     except Exception as e:
         logger.error(f"检查上传状态错误: {e}")
         return JSONResponse(
@@ -772,35 +1055,276 @@ async def get_upload_status():
 
 
 # Shell 命令执行相关代码保持不变
-SAFE_COMMANDS = {
+SAFE_COMMANDS = frozenset({
     'ls', 'pwd', 'cd', 'cat', 'echo', 'grep', 'find', 'head', 'tail', 
     'wc', 'sort', 'uniq', 'diff', 'cp', 'mv', 'mkdir', 'touch', 'date',
     'whoami', 'hostname', 'uname', 'df', 'du', 'ps', 'top', 'which',
     'git', 'npm', 'python', 'pip', 'node', 'yarn', 'curl', 'wget',
     'tree', 'clear', 'history'
-}
+})
 
-DANGEROUS_COMMANDS = {
+DANGEROUS_COMMANDS = frozenset({
     'rm', 'rmdir', 'kill', 'killall', 'shutdown', 'reboot', 'sudo',
     'su', 'chmod', 'chown', 'dd', 'format', 'mkfs', 'fdisk', 'apt',
     'yum', 'brew', 'systemctl', 'service', 'docker', 'kubectl'
+})
+
+# 出现这些字符时命令需要 shell 解释（管道、重定向、变量、通配符、多行等），不走进程内实现或直接 exec
+SHELL_METACHARACTERS = frozenset('|&;<>()$`\\*?[]{}~#!\n')
+# 不含空白、引号和反斜杠的命令经 shlex.split 后就是它本身，可以跳过分词
+SHELL_QUOTING_CHARACTERS = frozenset(' \t\r\n\'"\\')
+
+
+def _builtin_pwd(args: List[str], shell_state: Dict[str, Any]) -> Optional[Tuple[str, str, int]]:
+    """pwd：直接返回当前目录"""
+    if args:
+        return None
+    return f"{shell_state['cwd']}\n", "", 0
+
+
+def _builtin_echo(args: List[str], shell_state: Dict[str, Any]) -> Optional[Tuple[str, str, int]]:
+    """echo：不带选项时直接拼接参数"""
+    if args and args[0].startswith("-"):
+        return None
+    return " ".join(args) + "\n", "", 0
+
+
+def _builtin_ls(args: List[str], shell_state: Dict[str, Any]) -> Optional[Tuple[str, str, int]]:
+    """ls：不带选项、最多一个路径时按名称列出非隐藏条目"""
+    if len(args) > 1 or (args and args[0].startswith("-")):
+        return None
+    target = args[0] if args else "."
+    path = os.path.join(shell_state["cwd"], target)
+    try:
+        names = sorted(name for name in os.listdir(path) if not name.startswith("."))
+    except NotADirectoryError:
+        return f"{target}\n", "", 0
+    except FileNotFoundError:
+        return "", f"ls: cannot access '{target}': No such file or directory\n", 2
+    except PermissionError:
+        return "", f"ls: cannot open directory '{target}': Permission denied\n", 2
+    return "".join(f"{name}\n" for name in names), "", 0
+
+
+def _builtin_cd(args: List[str], shell_state: Dict[str, Any]) -> Optional[Tuple[str, str, int]]:
+    """cd：当前目录按连接保存在 shell_state 中，不能 os.chdir 改变整个服务器进程"""
+    target = args[0] if args else "~"
+    # join 遇到绝对路径时直接返回该路径，无需单独判断 isabs
+    new_dir = os.path.normpath(os.path.join(shell_state["cwd"], os.path.expanduser(target)))
+    try:
+        # 一次 stat 同时完成存在性和目录类型检查
+        is_dir = stat.S_ISDIR(os.stat(new_dir).st_mode)
+    except (FileNotFoundError, NotADirectoryError):
+        return "", f"cd: no such file or directory: {target}\n", 1
+    except PermissionError:
+        return "", f"cd: permission denied: {target}\n", 1
+    except OSError as e:
+        return "", f"cd: {e.strerror}: {target}\n", 1
+    if not is_dir:
+        return "", f"cd: not a directory: {target}\n", 1
+    shell_state["cwd"] = new_dir
+    return f"Changed directory to: {new_dir}\n", "", 0
+
+
+def _builtin_export(args: List[str], shell_state: Dict[str, Any]) -> Optional[Tuple[str, str, int]]:
+    """export：把 NAME=VALUE 写入本连接的环境变量，供之后的命令使用"""
+    if not args or not all("=" in arg and not arg.startswith("=") for arg in args):
+        return None
+    env = shell_state["env"]
+    if env is None:
+        # 首次修改时才复制服务器环境，此前子进程直接继承
+        env = shell_state["env"] = os.environ.copy()
+    for arg in args:
+        name, _, value = arg.partition("=")
+        env[name] = value
+    return "", "", 0
+
+
+# 进程内实现的命令；返回 (stdout, stderr, exit_code)，返回 None 时回退到子进程执行
+SHELL_BUILTINS: Dict[str, Callable[[List[str], Dict[str, Any]], Optional[Tuple[str, str, int]]]] = {
+    "cd": _builtin_cd,
+    "export": _builtin_export,
+    "pwd": _builtin_pwd,
+    "echo": _builtin_echo,
+    "ls": _builtin_ls,
 }
 
+# 命令执行超时（秒）
+SHELL_TIMEOUT = 30.0
+# 每次从管道读取的最大字节数：与 StreamReader 默认缓冲上限一致，
+# 一次唤醒即可取走缓冲区中已到达的全部数据
+SHELL_READ_SIZE = 1 << 16
+# 输出合并窗口（秒），窗口内到达的输出合并为一帧
+SHELL_FLUSH_INTERVAL = 0.02
+# 单条命令最多转发的输出字节数，超出后终止进程
+SHELL_OUTPUT_LIMIT = 1 << 20
+# 读取任务与转发之间最多积压的块数，队列满时读取任务暂停（背压）
+SHELL_QUEUE_SIZE = 64
+# 命令进程退出（含超时或超出输出上限被终止）后，继续读取剩余输出的最长时间（秒）
+SHELL_DRAIN_GRACE = 1.0
+# 没有输出时检查命令进程是否已退出的间隔（秒）
+SHELL_EXIT_POLL_INTERVAL = 0.1
+
+# 内容固定的结果帧在启动时预先序列化，发送时直接入队字节
+# 超时的命令由服务器终止，帧中不带 exit_code
+SHELL_TIMEOUT_FRAME = dumps({
+    "type": "shell_result",
+    "stderr": f"命令执行超时（{SHELL_TIMEOUT:g}秒）",
+    "timed_out": True
+})
+SHELL_NO_OUTPUT_FRAME = dumps({
+    "type": "shell_result",
+    "exit_code": 0,
+    "stdout": "命令执行完成（无输出）\n"
+})
+
+
+def _kill_process_group(process: asyncio.subprocess.Process):
+    """终止命令及其派生的子进程（命令在独立会话中启动，进程组号即其 pid）"""
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (AttributeError, ProcessLookupError, PermissionError):
+        if process.returncode is None:
+            process.kill()
+
+
+async def _pump_output(stream: asyncio.StreamReader, name: str, queue: asyncio.Queue):
+    """持续读取子进程的一个输出流，原始字节放入队列；结束时放入 None"""
+    while True:
+        chunk = await stream.read(SHELL_READ_SIZE)
+        if not chunk:
+            break
+        await queue.put((name, chunk))
+    await queue.put((name, None))
+
+
+async def _stream_process_output(process: asyncio.subprocess.Process, context: ConnectionContext) -> Tuple[bool, int]:
+    """边读边发送子进程输出，等待进程结束；返回 (是否产生过输出, 因超出上限被丢弃的字节数)"""
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=SHELL_QUEUE_SIZE)
+    readers = [
+        asyncio.create_task(_pump_output(process.stdout, "stdout", queue)),
+        asyncio.create_task(_pump_output(process.stderr, "stderr", queue)),
+    ]
+    # 每个流一个增量解码器：一个窗口内的字节只解码一次，跨块的多字节字符也能正确拼接
+    decoders = {
+        "stdout": codecs.getincrementaldecoder('utf-8')(errors='replace'),
+        "stderr": codecs.getincrementaldecoder('utf-8')(errors='replace'),
+    }
+    # 每个流一个在整个命令期间复用的缓冲区，窗口内的块直接追加，不再每个窗口新建列表再 join
+    pending = {"stdout": bytearray(), "stderr": bytearray()}
+    has_output = False
+    forwarded = 0
+    dropped = 0
+    open_streams = len(readers)
+    drain_deadline = None
+    
+    async def next_chunk():
+        """取下一块输出；进程退出后超过 SHELL_DRAIN_GRACE 仍未读完时返回 None。
+        脱离进程组的子进程（setsid、后台任务等）不会被终止，可能一直持有管道，不能以管道关闭作为结束条件；
+        process.wait() 要等管道关闭才返回，因此以 returncode 判断进程是否已退出"""
+        nonlocal drain_deadline
+        getter = asyncio.ensure_future(queue.get())
+        try:
+            while True:
+                if process.returncode is not None:
+                    if drain_deadline is None:
+                        drain_deadline = loop.time() + SHELL_DRAIN_GRACE
+                    done, _ = await asyncio.wait((getter,), timeout=max(0.0, drain_deadline - loop.time()))
+                    return getter.result() if done else None
+                done, _ = await asyncio.wait((getter,), timeout=SHELL_EXIT_POLL_INTERVAL)
+                if done:
+                    return getter.result()
+        finally:
+            # 取消等待中的 get 不会丢失队列中的数据
+            getter.cancel()
+    
+    def collect(name: str, chunk: Optional[bytes], closed: List[str]):
+        """把一块输出追加到对应流的缓冲区；chunk 为 None 表示该流已关闭"""
+        nonlocal open_streams, forwarded, dropped
+        if chunk is None:
+            open_streams -= 1
+            closed.append(name)
+            return
+        room = SHELL_OUTPUT_LIMIT - forwarded
+        if len(chunk) > room:
+            # 超出上限：丢弃多余部分并终止进程，剩余输出在进程退出后的宽限期内读完
+            dropped += len(chunk) - room
+            chunk = memoryview(chunk)[:room]
+            _kill_process_group(process)
+        forwarded += len(chunk)
+        pending[name] += chunk
+    
+    def flush(closed: List[str]):
+        """解码缓冲区中的输出并作为一帧入队"""
+        nonlocal has_output
+        frame = {"type": "shell_stream"}
+        for stream_name, buffer in pending.items():
+            final = stream_name in closed
+            if not buffer and not final:
+                continue
+            text = decoders[stream_name].decode(buffer, final=final)
+            buffer.clear()
+            if text:
+                frame[stream_name] = text
+        if len(frame) > 1:
+            has_output = True
+            context.enqueue(frame)
+    
+    try:
+        while open_streams:
+            item = await next_chunk()
+            if item is None:
+                break
+            name, chunk = item
+            # 等待一个合并窗口，把期间到达的输出一并取出
+            await asyncio.sleep(SHELL_FLUSH_INTERVAL)
+            closed = []
+            while True:
+                collect(name, chunk, closed)
+                try:
+                    name, chunk = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+            flush(closed)
+        
+        if open_streams:
+            # 宽限期已过：停止读取，把已经读到的输出发出去
+            for reader in readers:
+                reader.cancel()
+            closed = []
+            while not queue.empty():
+                name, chunk = queue.get_nowait()
+                collect(name, chunk, closed)
+            flush(list(pending))
+            # 关闭本端管道，不再等待仍持有写端的子进程；进程已退出，close 不会再发送信号
+            process._transport.close()
+        
+        await process.wait()
+        return has_output, dropped
+    finally:
+        for reader in readers:
+            reader.cancel()
+
+
+def _shell_error(context: ConnectionContext, error: str):
+    """发送 shell_error 帧"""
+    context.enqueue({"type": "shell_error", "error": error})
+
+
 async def execute_shell_command(command: str, context: ConnectionContext):
     """安全地执行 shell 命令（保持状态）"""
     try:
         shell_state = context.shell_state
-        websocket = context.websocket
         
-        try:
-            cmd_parts = shlex.split(command)
-        except ValueError as e:
-            # 使用简单格式发送错误消息
-            await websocket.send_json({
-                "type": "shell_error",
-                "error": f"命令解析错误: {str(e)}"
-            })
-            return
+        if command and SHELL_QUOTING_CHARACTERS.isdisjoint(command):
+            cmd_parts = [command]
+        else:
+            try:
+                cmd_parts = shlex.split(command)
+            except ValueError as e:
+                _shell_error(context, f"命令解析错误: {str(e)}")
+                return
             
         if not cmd_parts:
             return
@@ -808,115 +1332,108 @@ async def execute_shell_command(command: str, context: ConnectionContext):
         base_cmd = cmd_parts[0]
         
         if base_cmd in DANGEROUS_COMMANDS:
-            # 使用简单格式发送错误消息
-            await websocket.send_json({
-                "type": "shell_error",
-                "error": f"安全限制: 命令 '{base_cmd}' 已被禁用"
-            })
+            _shell_error(context, f"安全限制: 命令 '{base_cmd}' 已被禁用")
             return
             
         if base_cmd not in SAFE_COMMANDS:
             logger.warning(f"执行非白名单命令: {base_cmd}")
         
-        # 处理cd命令
-        if base_cmd == "cd":
-            try:
-                if len(cmd_parts) == 1:
-                    new_dir = os.path.expanduser("~")
-                else:
-                    new_dir = os.path.expanduser(cmd_parts[1])
-                
-                if not os.path.isabs(new_dir):
-                    new_dir = os.path.join(shell_state["cwd"], new_dir)
-                
-                new_dir = os.path.normpath(new_dir)
-                
-                if os.path.isdir(new_dir):
-                    shell_state["cwd"] = new_dir
-                    # 使用简单格式发送输出消息
-                    await websocket.send_json({
-                        "type": "shell_output",
-                        "output": f"Changed directory to: {new_dir}\n"
-                    })
-                else:
-                    # 使用简单格式发送错误消息
-                    await websocket.send_json({
-                        "type": "shell_error",
-                        "error": f"cd: no such file or directory: {cmd_parts[1]}\n"
-                    })
-            except Exception as e:
-                # 使用简单格式发送错误消息
-                await websocket.send_json({
-                    "type": "shell_error",
-                    "error": f"cd: {str(e)}\n"
-                })
-            return
-        
-        # 处理pwd命令
-        if base_cmd == "pwd":
-            # 使用简单格式发送输出消息
-            await websocket.send_json({
-                "type": "shell_output",
-                "output": f"{shell_state['cwd']}\n"
-            })
-            return
+        # 进程内实现的命令查表分派，避免 fork/exec；
+        # cd 修改的是本连接的目录状态，即使参数含 ~ 等字符也必须在进程内执行
+        plain = SHELL_METACHARACTERS.isdisjoint(command)
+        builtin = SHELL_BUILTINS.get(base_cmd)
+        if builtin is not None and (plain or builtin is _builtin_cd):
+            builtin_result = builtin(cmd_parts[1:], shell_state)
+            if builtin_result is not None:
+                stdout, stderr, exit_code = builtin_result
+                result = {"type": "shell_result", "exit_code": exit_code}
+                if stdout:
+                    result["stdout"] = stdout
+                if stderr:
+                    result["stderr"] = stderr
+                context.enqueue(result)
+                return
         
         # 创建进程
         logger.info(f"执行命令: {command} 在目录: {shell_state['cwd']}")
-        process = await asyncio.create_subprocess_shell(
-            command,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-            cwd=shell_state["cwd"],
-            env=shell_state["env"]
-        )
+        spawn_options = {
+            "stdout": asyncio.subprocess.PIPE,
+            "stderr": asyncio.subprocess.PIPE,
+            "cwd": shell_state["cwd"],
+            "env": shell_state["env"],
+            "start_new_session": True
+        }
+        loop = asyncio.get_running_loop()
+        spawn_started = loop.time()
+        process = None
+        # 不含 shell 语法的命令直接 exec，省去中间的 /bin/sh 进程
+        if plain and "=" not in base_cmd:
+            try:
+                process = await asyncio.create_subprocess_exec(*cmd_parts, **spawn_options)
+            except (FileNotFoundError, PermissionError):
+                # 找不到可执行文件（如 shell 内建命令）时交给 shell 处理并输出其错误信息
+                pass
+        if process is None:
+            process = await asyncio.create_subprocess_shell(command, **spawn_options)
+        read_started = loop.time()
         
+        # 超时只从进程启动完成后开始计算，主机繁忙时的 spawn 延迟不占用命令的执行时间；
+        # 到期直接终止进程组：管道随之关闭，读取自然结束，不需要取消正在进行的读取
+        timed_out = False
+        
+        def on_timeout():
+            nonlocal timed_out
+            timed_out = True
+            _kill_process_group(process)
+        
+        timeout_handle = loop.call_later(SHELL_TIMEOUT, on_timeout)
         try:
-            stdout, stderr = await asyncio.wait_for(
-                process.communicate(),
-                timeout=30.0
+            has_output, dropped = await _stream_process_output(process, context)
+        finally:
+            timeout_handle.cancel()
+        if logger.isEnabledFor(logging.DEBUG):
+            finished = loop.time()
+            logger.debug(
+                "命令耗时: 启动 %.1fms, 执行 %.1fms",
+                (read_started - spawn_started) * 1000,
+                (finished - read_started) * 1000
             )
-            
-            if stdout:
-                output = stdout.decode('utf-8', errors='replace')
-                # 使用简单格式发送输出消息
-                await websocket.send_json({
-                    "type": "shell_output",
-                    "output": output
-                })
-            
-            if stderr:
-                error = stderr.decode('utf-8', errors='replace')
-                # 使用简单格式发送错误消息
-                await websocket.send_json({
-                    "type": "shell_error",
-                    "error": error
-                })
-                
-            if not stdout and not stderr:
-                # 使用简单格式发送输出消息
-                await websocket.send_json({
-                    "type": "shell_output",
-                    "output": "命令执行完成（无输出）\n"
-                })
-                
-        except asyncio.TimeoutError:
-            process.terminate()
-            await process.wait()
-            # 使用简单格式发送错误消息
-            await websocket.send_json({
-                "type": "shell_error",
-                "error": "命令执行超时（30秒）"
-            })
+        
+        if timed_out:
+            context.enqueue(SHELL_TIMEOUT_FRAME)
+            return
+        if not has_output and process.returncode == 0:
+            context.enqueue(SHELL_NO_OUTPUT_FRAME)
+            return
+        
+        result = {
+            "type": "shell_result",
+            "exit_code": process.returncode
+        }
+        if dropped:
+            result["stderr"] = f"...[输出超过 {SHELL_OUTPUT_LIMIT} 字节，已截断 {dropped} 字节并终止命令]\n"
+            result["truncated"] = dropped
+        elif not has_output:
+            result["stdout"] = "命令执行完成（无输出）\n"
+        context.enqueue(result)
             
     except Exception as e:
-        logger.error(f"执行命令时出错: {e}")
-        # 使用简单格式发送错误消息
-        await websocket.send_json({
-            "type": "shell_error",
-            "error": f"执行命令失败: {str(e)}"
-        })
+        # 客户端已断开时不再构造和发送错误帧
+        if not context.is_open:
+            return
+        logger.exception("执行命令时出错")
+        _shell_error(context, f"执行命令失败: {str(e)}")
 
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # 使用 uvicorn[standard] 提供的 C 实现：uvloop 事件循环 + httptools 解析器；
+    # 平台上未安装时（如 Windows 没有 uvloop）回退到纯 Python 实现
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop" if importlib.util.find_spec("uvloop") else "asyncio",
+        http="httptools" if importlib.util.find_spec("httptools") else "h11",
+        ws="websockets",
+        ws_per_message_deflate=server_config["perMessageDeflate"]
+    )
\ No newline at end of file